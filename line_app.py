@@ -1,8 +1,17 @@
 # line_app.py
 from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, event as sa_event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.pool import NullPool
+from cachetools import TTLCache
+import redis
 from linebot.v3 import WebhookHandler
-from linebot.v3.messaging import MessagingApi, Configuration, ApiClient
+from linebot.v3.messaging import (
+    Configuration,
+    AsyncApiClient,
+    AsyncMessagingApi
+)
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, PostbackEvent
 from linebot.v3.messaging import (
     TextMessage,
@@ -11,23 +20,69 @@ from linebot.v3.messaging import (
     FlexContainer
 )
 import logging
+import json
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
 import os
 import asyncio
+import threading
+import time
+import atexit
 
 app = Flask(__name__)
 
 # 環境變數配置
 DATABASE_URL = os.environ.get('DATABASE_URL')
-if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
-    DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://')
+# 使用 psycopg 3 驅動：同一連線上重複執行的查詢會自動改用伺服器端 prepared statement
+if DATABASE_URL:
+    for prefix in ('postgres://', 'postgresql://'):
+        if DATABASE_URL.startswith(prefix):
+            DATABASE_URL = DATABASE_URL.replace(prefix, 'postgresql+psycopg://', 1)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if os.environ.get('DB_PGBOUNCER'):
+    # 前方有 pgbouncer（transaction pooling）時由其維護連線池，程序內不再保留連線；
+    # 交易之間可能換到不同的後端連線，因此關閉 psycopg 的 prepared statement
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': NullPool,
+        'connect_args': {'prepare_threshold': None},
+    }
+else:
+    # 連線池設定：借出前先檢查連線，並定期回收，避免使用已被伺服器中斷的閒置連線；
+    # LIFO 讓離峰時只重複使用少數連線，其餘閒置連線可被回收。
+    # 連線池用盡時最多等待數秒即失敗，不讓事件無限期排隊
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'pool_use_lifo': True,
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    }
 db = SQLAlchemy(app)
 
+if not os.environ.get('DB_PGBOUNCER'):
+    # 由伺服器中斷閒置過久的未結束交易，避免佔住連線與鎖；
+    # 於建立連線時以 SET 設定，不覆蓋 DATABASE_URL 中既有的 options 參數
+    with app.app_context():
+        if db.engine.dialect.name == 'postgresql':
+            @sa_event.listens_for(db.engine, 'connect')
+            def set_session_timeouts(dbapi_connection, connection_record):
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute("SET idle_in_transaction_session_timeout = 60000")
+                # SET 位於交易中，需先 commit，避免連線歸還時 rollback 還原設定
+                dbapi_connection.commit()
+
+# 設定 REDIS_URL 時，跨 worker 共用的狀態改存於 Redis。
+# 未設定時建立副本流程的狀態只存於程序內，Procfile 因此固定 gunicorn 只用單一 worker（以 threads 擴充）；
+# 要以多個 worker（--workers > 1）執行時必須設定 REDIS_URL
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -37,128 +92,593 @@ channel_access_token = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
 channel_secret = os.environ.get('LINE_CHANNEL_SECRET')
 
 configuration = Configuration(access_token=channel_access_token)
-api_client = ApiClient(configuration)
-messaging_api = MessagingApi(api_client)
+# LINE API client 於程序內只建立一次並重用 aiohttp 連線池，
+# 連線池上限即同時送出的 LINE API 請求數上限
+configuration.connection_pool_maxsize = int(
+    os.environ.get('LINE_API_POOL_SIZE', configuration.connection_pool_maxsize)
+)
 handler = WebhookHandler(channel_secret)
 
+# 整個程序共用一個長駐的背景 event loop，避免每次呼叫都建立/關閉 loop
+async_loop = asyncio.new_event_loop()
+threading.Thread(target=async_loop.run_forever, daemon=True).start()
+
+
+def run_async(coro):
+    """將協程交給背景 event loop 執行並等待結果"""
+    return asyncio.run_coroutine_threadsafe(coro, async_loop).result()
+
+
+async def create_async_api_client():
+    # aiohttp session 必須在其所屬的 event loop 中建立
+    return AsyncApiClient(configuration)
+
+async_api_client = run_async(create_async_api_client())
+async_messaging_api = AsyncMessagingApi(async_api_client)
+
+
+# 回覆佇列：處理事件的執行緒只負責放入回覆，由背景 event loop 上固定數量的消費者各自取出並送出，
+# 單一回覆卡住時不影響其他消費者；消費者數量預設與連線池上限相同
+REPLY_CONSUMERS = int(
+    os.environ.get('REPLY_CONSUMERS', configuration.connection_pool_maxsize)
+)
+# reply token 約一分鐘即失效，單次送出的逾時遠短於 SDK 預設的 300 秒
+REPLY_REQUEST_TIMEOUT = int(os.environ.get('REPLY_REQUEST_TIMEOUT', 10))
+
+
+async def create_reply_queue():
+    return asyncio.Queue()
+
+reply_queue = run_async(create_reply_queue())
+
+
+async def consume_replies():
+    while True:
+        request = await reply_queue.get()
+        try:
+            await async_messaging_api.reply_message(
+                request, _request_timeout=REPLY_REQUEST_TIMEOUT
+            )
+        except Exception as e:
+            logger.error("Error sending reply: %s", e)
+        finally:
+            reply_queue.task_done()
+
+
+async def start_reply_consumers():
+    return [asyncio.ensure_future(consume_replies()) for _ in range(REPLY_CONSUMERS)]
+
+reply_consumers = run_async(start_reply_consumers())
+
+
+async def stop_reply_consumers():
+    for consumer in reply_consumers:
+        consumer.cancel()
+    await asyncio.gather(*reply_consumers, return_exceptions=True)
+
+
+def reply_message(request):
+    """將回覆放入回覆佇列，不等待 LINE API 回應"""
+    async_loop.call_soon_threadsafe(reply_queue.put_nowait, request)
+
+
+# 背景處理 webhook 事件的執行緒池，讓 /callback 可以立即回應 LINE 平台
+# max_workers 同時也是單一 webhook 內多個事件的並行上限
+webhook_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('WEBHOOK_WORKERS', 4))
+)
+REPLY_DRAIN_TIMEOUT = 10
+
+
+def shutdown():
+    """程序結束前處理完已收到的事件並送出佇列中的回覆，再關閉 LINE API client"""
+    webhook_executor.shutdown(wait=True)
+    try:
+        run_async(asyncio.wait_for(reply_queue.join(), REPLY_DRAIN_TIMEOUT))
+    except asyncio.TimeoutError:
+        logger.warning("Timed out sending %s queued replies", reply_queue.qsize())
+    run_async(stop_reply_consumers())
+    run_async(async_api_client.close())
+
+atexit.register(shutdown)
+
 # Database Models
+# 開發用：設定 DB_RAISELOAD 時，未以 options 明確載入的關聯在存取時直接拋出例外，
+# 讓無意間加入的 lazy load (N+1) 立即失敗
+RELATIONSHIP_LAZY = 'raise_on_sql' if os.environ.get('DB_RAISELOAD') else 'select'
+
+
 class Activity(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    date = db.Column(db.String(30), nullable=False)
-    time = db.Column(db.String(30), nullable=False)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    # 副本開始時間；顯示時才格式化為日期與時間
+    starts_at = db.Column(db.DateTime, nullable=False, index=True)
     creator_id = db.Column(db.String(50), nullable=False)
-    participants = db.relationship('Participant', backref='activity', lazy=True)
+    # 參加者由資料庫的 ON DELETE CASCADE 一併刪除，ORM 不需先載入
+    participants = db.relationship(
+        'Participant',
+        back_populates='activity',
+        lazy=RELATIONSHIP_LAZY,
+        cascade='all, delete-orphan',
+        passive_deletes=True
+    )
 
 
 class Participant(db.Model):
+    __table_args__ = (
+        # 報名檢查以 (activity_id, user_id) 為前綴查詢；「+」指令允許同一用戶代報多個名字，
+        # 因此唯一性包含 user_name
+        db.UniqueConstraint('activity_id', 'user_id', 'user_name', name='uq_participant_activity_user'),
+        db.Index('ix_participant_activity_user_name', 'activity_id', 'user_name'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(50), nullable=False)
     user_name = db.Column(db.String(100))
-    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), nullable=False)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id', ondelete='CASCADE'), nullable=False)
+
+    activity = db.relationship('Activity', back_populates='participants', lazy=RELATIONSHIP_LAZY)
+
+
+# 常用查詢於載入時建立一次，執行時只帶入參數
+ACTIVITY_BY_NAME = db.select(Activity).where(Activity.name == db.bindparam('name'))
+# 取消報名：以 DELETE ... RETURNING 一次完成查找與刪除，不載入整列資料
+DELETE_PARTICIPANT_BY_USER = db.delete(Participant).where(
+    Participant.id == db.select(Participant.id).where(
+        Participant.activity_id == db.bindparam('activity_id'),
+        Participant.user_id == db.bindparam('user_id')
+    ).limit(1).scalar_subquery()
+).returning(Participant.id)
+# 「-」指令：與取消報名相同，以名單中的人員名稱刪除
+DELETE_PARTICIPANT_BY_NAME = db.delete(Participant).where(
+    Participant.id == db.select(Participant.id).where(
+        Participant.activity_id == db.bindparam('activity_id'),
+        Participant.user_name == db.bindparam('user_name')
+    ).limit(1).scalar_subquery()
+).returning(Participant.id)
+# 報名：尚未報名時才新增，檢查與寫入合併為單一 INSERT，
+# 由 (activity_id, user_id, ...) 唯一索引的前綴完成檢查；
+# 以 raw 策略執行，避免帶入參數時被 ORM 當成 bulk insert
+JOIN_ACTIVITY = (
+    insert(Participant)
+    .from_select(
+        ['user_id', 'user_name', 'activity_id'],
+        db.select(
+            db.bindparam('user_id', type_=db.String),
+            db.bindparam('user_name', type_=db.String),
+            db.bindparam('activity_id', type_=db.Integer)
+        ).where(~db.exists().where(
+            Participant.activity_id == db.bindparam('activity_id', type_=db.Integer),
+            Participant.user_id == db.bindparam('user_id', type_=db.String)
+        ))
+    )
+    .on_conflict_do_nothing()
+    .returning(Participant.id)
+    .execution_options(dml_strategy='raw')
+)
+PARTICIPANT_COUNT = db.select(func.count(Participant.id)).where(
+    Participant.activity_id == db.bindparam('activity_id')
+)
+# 「+」指令：查找副本、檢查名單是否已有同名人員與新增合併為單一語句。
+# CTE 中的 INSERT 與外層查詢使用同一份快照，外層計算的人數不含本次新增的資料
+_add_target = (
+    db.select(Activity.id, Activity.starts_at)
+    .where(Activity.name == db.bindparam('activity_name'))
+    .cte('target')
+)
+_add_inserted = (
+    insert(Participant)
+    .from_select(
+        ['user_id', 'user_name', 'activity_id'],
+        db.select(
+            db.bindparam('user_id', type_=db.String),
+            db.bindparam('user_name', type_=db.String),
+            _add_target.c.id
+        ).where(~db.exists().where(
+            Participant.activity_id == _add_target.c.id,
+            Participant.user_name == db.bindparam('user_name', type_=db.String)
+        ))
+    )
+    .on_conflict_do_nothing()
+    .returning(Participant.id)
+    .cte('inserted')
+)
+ADD_PARTICIPANT_BY_NAME = db.select(
+    _add_target.c.starts_at,
+    db.select(func.count()).select_from(_add_inserted).scalar_subquery().label('inserted'),
+    db.select(func.count(Participant.id))
+    .where(Participant.activity_id == _add_target.c.id)
+    .scalar_subquery().label('existing')
+)
+# 建立副本：名稱重複時由唯一索引略過，檢查與寫入合併為單一 INSERT
+CREATE_ACTIVITY = (
+    insert(Activity)
+    .values(
+        name=db.bindparam('name'),
+        starts_at=db.bindparam('starts_at'),
+        creator_id=db.bindparam('creator_id')
+    )
+    .on_conflict_do_nothing(index_elements=['name'])
+    .returning(Activity.id)
+)
+# 刪除副本：創建者檢查與刪除合併為單一 DELETE，參加者由外鍵 CASCADE 一併刪除
+DELETE_ACTIVITY_BY_CREATOR = (
+    db.delete(Activity)
+    .where(Activity.id == db.bindparam('activity_id'), Activity.creator_id == db.bindparam('user_id'))
+    .returning(Activity.name)
+)
+# 報名名單只需要副本欄位與參加者名稱，以單一查詢取得欄位而不建立 ORM 物件
+PARTICIPANT_LIST = (
+    db.select(Activity.name, Activity.starts_at, Participant.id, Participant.user_name)
+    .outerjoin(Activity.participants)
+    .where(Activity.id == db.bindparam('activity_id'))
+    .order_by(Participant.id)
+)
+# 單一查詢同時取得副本與參加人數，避免逐筆載入參加者 (N+1)
+ACTIVITIES_WITH_COUNT = (
+    db.select(Activity, func.count(Participant.id))
+    .outerjoin(Activity.participants)
+    .group_by(Activity.id)
+    .order_by(Activity.id)
+)
 
 
-# 使用者狀態追蹤
-user_states = {}
+# 使用者狀態追蹤：有 Redis 時存於 Redis，否則退回程序內有上限與逾時的快取
+USER_STATE_TTL = 600
+user_states = TTLCache(maxsize=10000, ttl=USER_STATE_TTL)
+user_states_lock = threading.Lock()
+
+
+def get_user_state(user_id):
+    if redis_client is not None:
+        return redis_client.hgetall(f"state:{user_id}") or None
+    with user_states_lock:
+        return user_states.get(user_id)
+
+def set_user_state(user_id, state):
+    if redis_client is not None:
+        # 以 hash 儲存各欄位，先刪除舊狀態避免殘留欄位，並與逾時設定一起送出
+        key = f"state:{user_id}"
+        pipe = redis_client.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping=state)
+        pipe.expire(key, USER_STATE_TTL)
+        pipe.execute()
+        return
+    with user_states_lock:
+        user_states[user_id] = state
+
+def clear_user_state(user_id):
+    if redis_client is not None:
+        redis_client.delete(f"state:{user_id}")
+        return
+    with user_states_lock:
+        user_states.pop(user_id, None)
+
+# LINE 用戶顯示名稱快取，避免每次 postback 都呼叫 get_profile；
+# 程序內快取之外，有 Redis 時也存於 Redis 供其他 worker 共用
+PROFILE_CACHE_TTL = 3600
+# 取得名稱後才會回覆，逾時預設與回覆相同，遠短於 SDK 預設的 300 秒
+PROFILE_REQUEST_TIMEOUT = int(os.environ.get('PROFILE_REQUEST_TIMEOUT', REPLY_REQUEST_TIMEOUT))
+profile_cache = TTLCache(maxsize=2048, ttl=PROFILE_CACHE_TTL)
+profile_cache_lock = threading.Lock()
 
 
 async def get_user_profile(user_id):
     """獲取 LINE 用戶資料"""
-    try:
-        profile = await messaging_api.get_profile(user_id)
-        return profile.display_name
-    except Exception as e:
-        logger.error(f"Error getting user profile: {e}")
-        return "未知用戶"
+    profile = await async_messaging_api.get_profile(
+        user_id, _request_timeout=PROFILE_REQUEST_TIMEOUT
+    )
+    return profile.display_name
 
-def run_async(coro):
-    """協助執行非同步函數的輔助函數"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(coro)
-    finally:
-        loop.close()
+def get_user_name(user_id):
+    """取得用戶顯示名稱，優先使用快取，取得失敗時以 user_id 代替；
+    可能呼叫 LINE API，應於開始資料庫交易前呼叫"""
+    with profile_cache_lock:
+        user_name = profile_cache.get(user_id)
+    if user_name is not None:
+        return user_name
+
+    if redis_client is not None:
+        user_name = redis_client.get(f"lineprof:{user_id}")
+
+    if user_name is None:
+        try:
+            user_name = run_async(get_user_profile(user_id))
+        except Exception as e:
+            logger.error("Error getting user profile: %s", e)
+            return user_id
+        if redis_client is not None:
+            redis_client.setex(f"lineprof:{user_id}", PROFILE_CACHE_TTL, user_name)
+
+    with profile_cache_lock:
+        profile_cache[user_id] = user_name
+    return user_name
+
+def count_participants(activity_id):
+    """以 COUNT 計算副本參加人數，不載入參加者資料"""
+    return db.session.scalar(PARTICIPANT_COUNT, {'activity_id': activity_id})
+
+
+# 副本建立後內容不再變動，有 Redis 時以 id 快取副本欄位，
+# 報名/取消等 postback 不必每次查詢資料庫。
+# 快取只在 key 不存在時寫入 (SET NX)；刪除副本時改寫為空字串的刪除標記，
+# 讓刪除前已讀到資料庫的請求無法再把已刪除的副本寫回快取。
+# key 帶有快取世代，刪除所有副本或重建表格時遞增世代，舊世代的 key 由逾時自然清除
+ACTIVITY_CACHE_TTL = 300
+ACTIVITY_DELETED = ''
+ACTIVITY_CACHE_GEN_KEY = 'activities:gen'
+
+
+def activity_cache_key(activity_id):
+    gen = redis_client.get(ACTIVITY_CACHE_GEN_KEY) or 0
+    return f"activity:{gen}:{activity_id}"
+
+
+def get_activity(activity_id):
+    """以 id 取得副本，快取命中時回傳未加入 session 的 Activity 物件"""
+    if redis_client is None:
+        return db.session.get(Activity, activity_id)
+
+    key = activity_cache_key(activity_id)
+    cached = redis_client.get(key)
+    if cached == ACTIVITY_DELETED:
+        return None
+    if cached is not None:
+        cached = json.loads(cached)
+        return Activity(
+            id=activity_id,
+            name=cached['name'],
+            starts_at=datetime.fromisoformat(cached['starts_at']),
+            creator_id=cached['creator_id']
+        )
+
+    activity = db.session.get(Activity, activity_id)
+    if activity:
+        redis_client.set(key, json.dumps({
+            'name': activity.name,
+            'starts_at': activity.starts_at.isoformat(),
+            'creator_id': activity.creator_id
+        }), nx=True, ex=ACTIVITY_CACHE_TTL)
+    return activity
+
+
+def clear_activity_cache(activity_id=None):
+    """將單一副本的快取改為刪除標記；未指定 id 時遞增世代，使所有副本的快取失效"""
+    if redis_client is None:
+        return
+    if activity_id is not None:
+        redis_client.set(activity_cache_key(activity_id), ACTIVITY_DELETED, ex=ACTIVITY_CACHE_TTL)
+        return
+    # 世代遞增前已讀到資料庫的請求只會寫入舊世代的 key，不影響之後的讀取
+    redis_client.incr(ACTIVITY_CACHE_GEN_KEY)
+
+
+# 固定內容的文字回覆於載入時建立一次，只有 ReplyMessageRequest 需要每次帶入 reply_token
+NO_ACTIVITIES_MESSAGE = TextMessage(text="目前沒有任何副本")
+ADD_FORMAT_ERROR_MESSAGE = TextMessage(text="指令格式錯誤。請使用：+ [副本名稱] [人員名稱]")
+REMOVE_FORMAT_ERROR_MESSAGE = TextMessage(text="指令格式錯誤。請使用：➜ - [副本名稱] [人員名稱]")
+ACTIVITY_NAME_REQUIRED_MESSAGE = TextMessage(text="請輸入副本名稱，例如：副本 副本")
+TEXT_ERROR_MESSAGE = TextMessage(text="處理您的請求時發生錯誤，請稍後再試。")
+RESTART_CREATION_MESSAGE = TextMessage(text="請重新開始建立副本流程")
+INVALID_ACTIVITY_NAME_MESSAGE = TextMessage(text="副本名稱無效，請重新輸入")
+CREATE_ERROR_MESSAGE = TextMessage(text="建立副本時發生錯誤，請稍後再試")
+ALL_DELETED_MESSAGE = TextMessage(text="所有副本已刪除")
+DELETE_ALL_CANCELLED_MESSAGE = TextMessage(text="已取消刪除所有副本")
+POSTBACK_ERROR_MESSAGE = TextMessage(text="處理請求時發生錯誤，請稍後再試。")
+
+
+# 固定內容的 Flex 訊息於載入時建立一次，避免每次請求重複建構與驗證
+ACTIVITY_NAME_INPUT_CONTAINER = FlexContainer.from_dict({
+    "type": "bubble",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "建立新副本",
+                "weight": "bold",
+                "size": "xl",
+                "color": "#1DB446"
+            },
+            {
+                "type": "separator",
+                "margin": "lg"
+            },
+            {
+                "type": "text",
+                "text": "請輸入副本名稱",
+                "margin": "lg"
+            }
+        ]
+    }
+})
+ACTIVITY_NAME_INPUT_MESSAGE = FlexMessage(
+    alt_text="輸入副本名稱",
+    contents=ACTIVITY_NAME_INPUT_CONTAINER
+)
 
 
 def create_activity_name_input():
-    flex_content = {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "建立新副本",
-                    "weight": "bold",
-                    "size": "xl",
-                    "color": "#1DB446"
-                },
-                {
-                    "type": "separator",
-                    "margin": "lg"
-                },
-                {
-                    "type": "text",
-                    "text": "請輸入副本名稱",
-                    "margin": "lg"
+    return ACTIVITY_NAME_INPUT_MESSAGE
+
+
+DATETIME_PICKER_CONTAINER = FlexContainer.from_dict({
+    "type": "bubble",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "選擇副本時間",
+                "weight": "bold",
+                "size": "xl",
+                "color": "#1DB446"
+            },
+            {
+                "type": "separator",
+                "margin": "lg"
+            },
+            {
+                "type": "button",
+                "style": "primary",
+                "margin": "md",
+                "action": {
+                    "type": "datetimepicker",
+                    "label": "選擇日期時間",
+                    "data": "action=select_date",
+                    "mode": "datetime"
                 }
-            ]
-        }
+            }
+        ]
     }
-    return FlexMessage(
-        alt_text="輸入副本名稱",
-        contents=FlexContainer.from_dict(flex_content)
-    )
+})
+DATETIME_PICKER_MESSAGE = FlexMessage(
+    alt_text="選擇副本時間",
+    contents=DATETIME_PICKER_CONTAINER
+)
 
 
 def create_datetime_picker_flex():
-    flex_content = {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "選擇副本時間",
-                    "weight": "bold",
-                    "size": "xl",
-                    "color": "#1DB446"
-                },
-                {
-                    "type": "separator",
-                    "margin": "lg"
-                },
-                {
-                    "type": "button",
-                    "style": "primary",
-                    "margin": "md",
-                    "action": {
-                        "type": "datetimepicker",
-                        "label": "選擇日期時間",
-                        "data": "action=select_date",
-                        "mode": "datetime"
+    return DATETIME_PICKER_MESSAGE
+
+
+DELETE_ALL_CONFIRMATION_CONTAINER = FlexContainer.from_dict({
+    "type": "bubble",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "確認刪除所有副本？",
+                "weight": "bold",
+                "size": "xl",
+                "align": "center"
+            },
+            {
+                "type": "separator",
+                "margin": "lg"
+            },
+            {
+                "type": "box",
+                "layout": "horizontal",
+                "margin": "md",
+                "spacing": "sm",
+                "contents": [
+                    {
+                        "type": "button",
+                        "style": "primary",
+                        "height": "sm",
+                        "action": {
+                            "type": "postback",
+                            "label": "是",
+                            "data": "action=confirm_delete_all"
+                        }
+                    },
+                    {
+                        "type": "button",
+                        "style": "secondary",
+                        "height": "sm",
+                        "action": {
+                            "type": "postback",
+                            "label": "否",
+                            "data": "action=cancel_delete_all"
+                        }
                     }
-                }
-            ]
-        }
+                ]
+            }
+        ]
     }
+})
+DELETE_ALL_CONFIRMATION_MESSAGE = FlexMessage(
+    alt_text="確認刪除所有副本？",
+    contents=DELETE_ALL_CONFIRMATION_CONTAINER
+)
+
+
+def create_delete_all_confirmation_flex():
+    return DELETE_ALL_CONFIRMATION_MESSAGE
+
+
+# 副本列表快取：副本或參加者有異動時遞增版本使快取失效。
+# 有 Redis 時版本與列表 JSON 存於 Redis 供所有 worker 共用；
+# 否則其他 worker 的異動不會更新本程序的版本，因此程序內快取最多只保留數秒
+ACTIVITIES_LIST_CACHE_TTL = 5
+ACTIVITIES_LIST_REDIS_TTL = 300
+activities_version = 0
+activities_list_cache = None  # (版本, 到期時間, FlexContainer 或 None)
+activities_list_lock = threading.Lock()
+
+
+def get_activities_version():
+    if redis_client is not None:
+        return int(redis_client.get("activities:ver") or 0)
+    with activities_list_lock:
+        return activities_version
+
+
+def bump_activities_version():
+    """副本或參加者異動後呼叫，使副本列表快取失效"""
+    global activities_version
+    if redis_client is not None:
+        redis_client.incr("activities:ver")
+        return
+    with activities_list_lock:
+        activities_version += 1
+
+
+def create_activities_list_flex():
+    global activities_list_cache
+    now = time.monotonic()
+    version = get_activities_version()
+    with activities_list_lock:
+        cached = activities_list_cache
+
+    if cached and cached[0] == version and cached[1] > now:
+        container = cached[2]
+    else:
+        container = load_activities_list_container(version)
+        with activities_list_lock:
+            activities_list_cache = (version, now + ACTIVITIES_LIST_CACHE_TTL, container)
+
+    if container is None:
+        return NO_ACTIVITIES_MESSAGE
     return FlexMessage(
-        alt_text="選擇副本時間",
-        contents=FlexContainer.from_dict(flex_content)
+        alt_text="副本列表",
+        contents=container
     )
 
 
-def create_activities_list_flex():
-    activities = Activity.query.all()
+def load_activities_list_container(version):
+    """取得副本列表的 FlexContainer，有 Redis 時先查詢該版本已序列化的 JSON"""
+    if redis_client is None:
+        flex_content = build_activities_list_content()
+    else:
+        key = f"activities:flex:{version}"
+        cached = redis_client.get(key)
+        if cached is not None:
+            flex_content = json.loads(cached)
+        else:
+            flex_content = build_activities_list_content()
+            redis_client.setex(key, ACTIVITIES_LIST_REDIS_TTL, json.dumps(flex_content))
+
+    if flex_content is None:
+        return None
+    return FlexContainer.from_dict(flex_content)
 
-    if not activities:
-        return TextMessage(text="目前沒有任何副本")
+
+def build_activities_list_content():
+    """查詢資料庫並建立副本列表的 Flex 內容，沒有副本時回傳 None"""
+    rows = db.session.execute(ACTIVITIES_WITH_COUNT).all()
+
+    if not rows:
+        return None
 
     contents = []
-    for activity in activities:
+    for activity, participant_count in rows:
         # 副本資訊
         activity_info = [
             {
@@ -169,17 +689,17 @@ def create_activities_list_flex():
             },
             {
                 "type": "text",
-                "text": f"日期: {activity.date}",
+                "text": f"日期: {activity.starts_at:%Y-%m-%d}",
                 "size": "sm"
             },
             {
                 "type": "text",
-                "text": f"時間: {activity.time}",
+                "text": f"時間: {activity.starts_at:%H:%M}",
                 "size": "sm"
             },
             {
                 "type": "text",
-                "text": f"參加人數: {len(activity.participants)}",
+                "text": f"參加人數: {participant_count}",
                 "size": "sm"
             }
         ]
@@ -200,7 +720,7 @@ def create_activities_list_flex():
                     "action": {
                         "type": "postback",
                         "label": "報名",
-                        "data": f"action=join_activity&id={activity.id}"
+                        "data": f"j:{activity.id}"
                     }
                 },
                 {
@@ -212,7 +732,7 @@ def create_activities_list_flex():
                     "action": {
                         "type": "postback",
                         "label": "取消",
-                        "data": f"action=cancel_join&id={activity.id}"
+                        "data": f"c:{activity.id}"
                     }
                 },
                 {
@@ -224,7 +744,7 @@ def create_activities_list_flex():
                     "action": {
                         "type": "postback",
                         "label": "名單",
-                        "data": f"action=view_participants&id={activity.id}"
+                        "data": f"v:{activity.id}"
                     }
                 },
                 {
@@ -237,7 +757,7 @@ def create_activities_list_flex():
                     "action": {
                         "type": "postback",
                         "label": "移除",
-                        "data": f"action=delete_activity&id={activity.id}"
+                        "data": f"d:{activity.id}"
                     }
                 }
             ]
@@ -271,512 +791,548 @@ def create_activities_list_flex():
                         ] + contents
         }
     }
-    return FlexMessage(
-        alt_text="副本列表",
-        contents=FlexContainer.from_dict(flex_content)
-    )
+    return flex_content
+
+
+# 開發用：設定 QUERY_COUNT_LIMIT 時統計每個事件執行的 SQL 數量，
+# 超過上限即記錄警告，及早發現新加入的 N+1 查詢
+QUERY_COUNT_LIMIT = int(os.environ.get('QUERY_COUNT_LIMIT', 0))
+query_counter = threading.local()
+
+if QUERY_COUNT_LIMIT:
+    with app.app_context():
+        @sa_event.listens_for(db.engine, 'before_cursor_execute')
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            query_counter.count = getattr(query_counter, 'count', 0) + 1
+
+
+def submit_event(func, event):
+    """將單一事件交給執行緒池處理，同一 webhook 內的多個事件可並行執行"""
+    def run():
+        query_counter.count = 0
+        with app.app_context():
+            try:
+                func(event)
+            except Exception as e:
+                logger.error("Error while handling event: %s", e, exc_info=True)
+        if QUERY_COUNT_LIMIT and query_counter.count > QUERY_COUNT_LIMIT:
+            logger.warning(
+                "%s executed %s queries (limit %s)",
+                func.__name__, query_counter.count, QUERY_COUNT_LIMIT
+            )
+
+    webhook_executor.submit(run)
 
 
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
+    # 驗證簽章並解析事件後立即回應 200，各事件的資料庫與 LINE API 工作在背景並行處理
     try:
         handler.handle(body, signature)
     except Exception as e:
-        logger.error(f"Error: {e}")
+        logger.error("Error: %s", e)
     return 'OK'
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_text_message(event):
-    try:
-        user_id = event.source.user_id
-        text = event.message.text
+def cmd_confirm_delete_all(event, user_id, args):
+    """刪除所有副本：先回覆確認訊息"""
+    confirmation_message = create_delete_all_confirmation_flex()
+    request = ReplyMessageRequest(
+        reply_token=event.reply_token,
+        messages=[confirmation_message]
+    )
+    reply_message(request)
 
-        # 處理刪除所有副本的命令
-        if text == "刪除所有副本":
-            confirmation_message = FlexMessage(
-                alt_text="確認刪除所有副本？",
-                contents=FlexContainer.from_dict({
-                    "type": "bubble",
-                    "body": {
-                        "type": "box",
-                        "layout": "vertical",
-                        "contents": [
-                            {
-                                "type": "text",
-                                "text": "確認刪除所有副本？",
-                                "weight": "bold",
-                                "size": "xl",
-                                "align": "center"
-                            },
-                            {
-                                "type": "separator",
-                                "margin": "lg"
-                            },
-                            {
-                                "type": "box",
-                                "layout": "horizontal",
-                                "margin": "md",
-                                "spacing": "sm",
-                                "contents": [
-                                    {
-                                        "type": "button",
-                                        "style": "primary",
-                                        "height": "sm",
-                                        "action": {
-                                            "type": "postback",
-                                            "label": "是",
-                                            "data": "action=confirm_delete_all"
-                                        }
-                                    },
-                                    {
-                                        "type": "button",
-                                        "style": "secondary",
-                                        "height": "sm",
-                                        "action": {
-                                            "type": "postback",
-                                            "label": "否",
-                                            "data": "action=cancel_delete_all"
-                                        }
-                                    }
-                                ]
-                            }
-                        ]
-                    }
-                })
-            )
-            request = ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[confirmation_message]
-            )
-            messaging_api.reply_message(request)
-            return
 
-        # 處理新增人員指令
-        if text.startswith("+ "):
-            parts = text.split(" ")
-            if len(parts) == 3:
-                activity_name = parts[1]
-                new_participant_name = parts[2]
-
-                activity = Activity.query.filter_by(name=activity_name).first()
-
-                if activity:
-                    existing_participant = Participant.query.filter_by(
-                        activity_id=activity.id,
-                        user_name=new_participant_name
-                    ).first()
-
-                    if existing_participant:
-                        response_text = f"➜{activity_name}：{new_participant_name} 已存在報名名單中"
-                    else:
-                        new_participant = Participant(
-                            user_id=user_id,
-                            user_name=new_participant_name,
-                            activity_id=activity.id
-                        )
-                        db.session.add(new_participant)
-                        db.session.commit()
-
-                        response_text = (
-                            f"➜{activity_name}：{new_participant_name} 已成功報名\n"
-                            f"日期：{activity.date}\n"
-                            f"時間：{activity.time}\n"
-                            f"目前參加人數：{len(activity.participants)}"
-                        )
-
-                    request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=response_text)]
-                    )
-                    messaging_api.reply_message(request)
-                else:
-                    request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=f"找不到名為 {activity_name} 的副本")]
-                    )
-                    messaging_api.reply_message(request)
+def cmd_add_participant(event, user_id, args):
+    """+ [副本名稱] [人員名稱]：新增特定人員到副本"""
+    # 以 partition 取代 split，不另建串列；仍只接受「名稱 空格 人員」兩段
+    activity_name, _, new_participant_name = args.partition(" ")
+    if new_participant_name and " " not in new_participant_name:
+
+        row = db.session.execute(ADD_PARTICIPANT_BY_NAME, {
+            'activity_name': activity_name,
+            'user_id': user_id,
+            'user_name': new_participant_name
+        }).first()
+        db.session.commit()
+
+        if row:
+            if not row.inserted:
+                response_text = f"➜{activity_name}：{new_participant_name} 已存在報名名單中"
             else:
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="指令格式錯誤。請使用：+ [副本名稱] [人員名稱]")]
+                bump_activities_version()
+                response_text = (
+                    f"➜{activity_name}：{new_participant_name} 已成功報名\n"
+                    f"日期：{row.starts_at:%Y-%m-%d}\n"
+                    f"時間：{row.starts_at:%H:%M}\n"
+                    f"目前參加人數：{row.existing + row.inserted}"
                 )
-                messaging_api.reply_message(request)
-
-        # 處理說明指令
-        elif text == "說明":
-            help_text = (
-                "📝 指令說明\n"
-                "-------------------\n"
-                "1. 建立副本：\n"
-                "➜ 副本 [副本名稱]\n"
-                "例如：副本 打牌\n\n"
-                "2. 查看副本列表：\n"
-                "➜ 副本\n\n"
-                "3. 副本功能：\n"
-                "➜ 報名 - 參加副本\n"
-                "➜ 取消 - 取消報名\n"
-                "➜ 名單 - 查看報名名單\n"
-                "➜ 移除 - 刪除副本(限創建者)\n"
-                "➜ 刪除所有副本 - 清空所有副本列表 (需確認)\n"
-                "➜ + [副本名稱] [人員名稱] - 新增特定人員到副本\n"
-                "➜ - [副本名稱] [人員名稱] - 於副本名單中刪除特定人員"
+
+            request = ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=response_text)]
             )
+            reply_message(request)
+        else:
             request = ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[TextMessage(text=help_text)]
+                messages=[TextMessage(text=f"找不到名為 {activity_name} 的副本")]
             )
-            messaging_api.reply_message(request)
-
-        # 處理刪除特定人員指令
-        elif text.startswith("- "):
-            command = text[2:].strip()
-            parts = command.split(" ")
-            if len(parts) == 2:
-                activity_name = parts[0]
-                participant_name = parts[1]
-
-                activity = Activity.query.filter_by(name=activity_name).first()
-
-                if activity:
-                    participant = Participant.query.filter_by(
-                        activity_id=activity.id,
-                        user_name=participant_name
-                    ).first()
-
-                    if participant:
-                        db.session.delete(participant)
-                        db.session.commit()
-                        response_text = f"➜{activity_name}：{participant_name} 已從副本名單中刪除"
-                    else:
-                        response_text = f"➜{activity_name}：找不到 {participant_name} 的報名紀錄"
-
-                    request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=response_text)]
-                    )
-                    messaging_api.reply_message(request)
-                else:
-                    request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=f"找不到名為 {activity_name} 的副本")]
-                    )
-                    messaging_api.reply_message(request)
-            else:
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="指令格式錯誤。請使用：➜ - [副本名稱] [人員名稱]")]
-                )
-                messaging_api.reply_message(request)
-
-        # 處理建立副本指令
-        elif text.startswith("副本 "):
-            activity_name = text[3:].strip()
-            if activity_name:
-                user_states[user_id] = {
-                    'step': 'datetime',
-                    'name': activity_name
-                }
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[create_datetime_picker_flex()]
-                )
-                messaging_api.reply_message(request)
+            reply_message(request)
+    else:
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[ADD_FORMAT_ERROR_MESSAGE]
+        )
+        reply_message(request)
+
+
+# 說明內容固定，於載入時建立一次
+HELP_TEXT = (
+    "📝 指令說明\n"
+    "-------------------\n"
+    "1. 建立副本：\n"
+    "➜ 副本 [副本名稱]\n"
+    "例如：副本 打牌\n\n"
+    "2. 查看副本列表：\n"
+    "➜ 副本\n\n"
+    "3. 副本功能：\n"
+    "➜ 報名 - 參加副本\n"
+    "➜ 取消 - 取消報名\n"
+    "➜ 名單 - 查看報名名單\n"
+    "➜ 移除 - 刪除副本(限創建者)\n"
+    "➜ 刪除所有副本 - 清空所有副本列表 (需確認)\n"
+    "➜ + [副本名稱] [人員名稱] - 新增特定人員到副本\n"
+    "➜ - [副本名稱] [人員名稱] - 於副本名單中刪除特定人員"
+)
+HELP_MESSAGE = TextMessage(text=HELP_TEXT)
+
+
+def cmd_help(event, user_id, args):
+    """說明：回覆指令說明"""
+    request = ReplyMessageRequest(
+        reply_token=event.reply_token,
+        messages=[HELP_MESSAGE]
+    )
+    reply_message(request)
+
+
+def cmd_remove_participant(event, user_id, args):
+    """- [副本名稱] [人員名稱]：於副本名單中刪除特定人員"""
+    activity_name, _, participant_name = args.strip().partition(" ")
+    if participant_name and " " not in participant_name:
+
+        activity = db.session.scalar(ACTIVITY_BY_NAME, {'name': activity_name})
+
+        if activity:
+            # 以 DELETE ... RETURNING 一次完成查找與刪除
+            deleted_id = db.session.scalar(
+                DELETE_PARTICIPANT_BY_NAME, {'activity_id': activity.id, 'user_name': participant_name}
+            )
+            db.session.commit()
+
+            if deleted_id is not None:
+                bump_activities_version()
+                response_text = f"➜{activity_name}：{participant_name} 已從副本名單中刪除"
             else:
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="請輸入副本名稱，例如：副本 副本")]
-                )
-                messaging_api.reply_message(request)
+                response_text = f"➜{activity_name}：找不到 {participant_name} 的報名紀錄"
 
-        # 處理查看副本列表指令
-        elif text == "副本":
             request = ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[create_activities_list_flex()]
+                messages=[TextMessage(text=response_text)]
+            )
+            reply_message(request)
+        else:
+            request = ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=f"找不到名為 {activity_name} 的副本")]
             )
-            messaging_api.reply_message(request)
+            reply_message(request)
+    else:
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[REMOVE_FORMAT_ERROR_MESSAGE]
+        )
+        reply_message(request)
 
-    except Exception as e:
-        logger.error(f"Error in handle_text_message: {e}", exc_info=True)
-        # 發送錯誤消息給用戶
+
+def cmd_create_activity(event, user_id, args):
+    """副本 [副本名稱]：開始建立副本流程"""
+    activity_name = args.strip()
+    if activity_name:
+        set_user_state(user_id, {
+            'step': 'datetime',
+            'name': activity_name
+        })
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[create_datetime_picker_flex()]
+        )
+        reply_message(request)
+    else:
         request = ReplyMessageRequest(
             reply_token=event.reply_token,
-            messages=[TextMessage(text="處理您的請求時發生錯誤，請稍後再試。")]
+            messages=[ACTIVITY_NAME_REQUIRED_MESSAGE]
         )
-        messaging_api.reply_message(request)
+        reply_message(request)
 
 
-@handler.add(PostbackEvent)
-def handle_postback(event):
-    try:
-        user_id = event.source.user_id
-        data = event.postback.data
+def cmd_list_activities(event, user_id, args):
+    """副本：回覆副本列表"""
+    request = ReplyMessageRequest(
+        reply_token=event.reply_token,
+        messages=[create_activities_list_flex()]
+    )
+    reply_message(request)
 
-        # 副本建立流程
-        if "action=select_date" in data and hasattr(event.postback, 'params'):
-            datetime_selected = event.postback.params.get('datetime')
-            logger.info(f"Received datetime_selected: {datetime_selected}")
-
-            # 檢查用戶狀態
-            user_state = user_states.get(user_id)
-            if not user_state:
-                logger.error(f"找不到使用者 {user_id} 的狀態")
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="請重新開始建立副本流程")]
-                )
-                messaging_api.reply_message(request)
-                return
 
-            # 確認用戶狀態和活動名稱
+# 完全相符的指令以字典查找，其餘依前綴比對；處理函數收到的 args 為去除前綴後的內容
+TEXT_COMMANDS = {
+    "刪除所有副本": cmd_confirm_delete_all,
+    "說明": cmd_help,
+    "副本": cmd_list_activities,
+}
 
-            if not user_state or 'name' not in user_state:
-                logger.error(f"使用者 {user_id} 的狀態無效")
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="請重新開始建立副本流程")]
-                )
-                messaging_api.reply_message(request)
-                return
+TEXT_PREFIX_COMMANDS = (
+    ("+ ", cmd_add_participant),
+    ("- ", cmd_remove_participant),
+    ("副本 ", cmd_create_activity),
+)
 
-            activity_name = user_state.get('name')
 
-            # 檢查活動名稱是否存在
-            if not activity_name:
-                logger.error("活動名稱遺失")
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="副本名稱無效，請重新輸入")]
-                )
-                messaging_api.reply_message(request)
-                return
+def handle_text_message(event):
+    try:
+        user_id = event.source.user_id
+        text = event.message.text
 
-            try:
-                # 檢查是否已存在相同名稱的副本
-                existing_activity = Activity.query.filter_by(name=activity_name).first()
-                if existing_activity:
-                    logger.info(f"名為 {activity_name} 的副本已存在")
-                    response_text = f"已存在名為 {activity_name} 的副本"
-                    request = ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=response_text)]
-                    )
-                    messaging_api.reply_message(request)
-                    return
-
-                # 將日期時間字串轉換為 datetime 物件
-                dt_object = datetime.strptime(datetime_selected, '%Y-%m-%dT%H:%M')
-
-                # 提取日期和時間
-                date_selected = dt_object.strftime('%Y-%m-%d')
-                time_selected = dt_object.strftime('%H:%M')
-
-                # 建立新的副本
-                new_activity = Activity(
-                    name=activity_name,
-                    date=date_selected,
-                    time=time_selected,
-                    creator_id=user_id
-                )
-                db.session.add(new_activity)
-                db.session.commit()
+        command = TEXT_COMMANDS.get(text)
+        if command:
+            command(event, user_id, "")
+            return
 
-                # 清除用戶狀態
-                del user_states[user_id]
+        for prefix, command in TEXT_PREFIX_COMMANDS:
+            if text.startswith(prefix):
+                command(event, user_id, text[len(prefix):])
+                return
+    except Exception as e:
+        logger.error("Error in handle_text_message: %s", e, exc_info=True)
+        # 發送錯誤消息給用戶
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TEXT_ERROR_MESSAGE]
+        )
+        reply_message(request)
 
-                # 顯示副本列表
-                activities_list = create_activities_list_flex()
 
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[activities_list]
-                )
-                messaging_api.reply_message(request)
+def postback_select_date(event, user_id, params):
+    """副本建立流程：以選擇的日期時間建立副本"""
+    if not hasattr(event.postback, 'params'):
+        return
 
-            except Exception as e:
-                logger.error(f"建立副本時發生資料庫錯誤：{str(e)}", exc_info=True)
-                db.session.rollback()
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="建立副本時發生錯誤，請稍後再試")]
-                )
-                messaging_api.reply_message(request)
-                return
+    datetime_selected = event.postback.params.get('datetime')
+    logger.info("Received datetime_selected: %s", datetime_selected)
 
-        # 報名功能
-        elif "action=join_activity" in data:
-            activity_id = int(data.split('&id=')[1])
-            activity = Activity.query.get(activity_id)
-
-            if activity:
-                # 獲取用戶名稱
-                try:
-                    profile = messaging_api.get_profile(user_id)
-                    user_name = profile.display_name
-                except Exception as e:
-                    logger.error(f"Error getting user profile: {e}")
-                    user_name = user_id
-
-                # 檢查是否已經報名
-                existing_participant = Participant.query.filter_by(
-                    activity_id=activity_id,
-                    user_id=user_id
-                ).first()
-
-                if existing_participant:
-                    response_text = f"➜{activity.name}：{user_name} 已報名"
-                else:
-                    # 建立新的參與者
-                    new_participant = Participant(
-                        user_id=user_id,
-                        user_name=user_name,
-                        activity_id=activity_id
-                    )
-                    db.session.add(new_participant)
-                    db.session.commit()
-
-                    response_text = (
-                        f"➜{activity.name}：{user_name} 已成功報名\n"
-                        f"日期：{activity.date}\n"
-                        f"時間：{activity.time}\n"
-                        f"目前參加人數：{len(activity.participants)}"
-                    )
-
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=response_text)]
-                )
-                messaging_api.reply_message(request)
+    # 檢查用戶狀態
+    user_state = get_user_state(user_id)
+    if not user_state:
+        logger.error("找不到使用者 %s 的狀態", user_id)
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[RESTART_CREATION_MESSAGE]
+        )
+        reply_message(request)
+        return
 
-        # 取消報名功能
-        elif "action=cancel_join" in data:
-            activity_id = int(data.split('&id=')[1])
-            activity = Activity.query.get(activity_id)
+    # 確認用戶狀態和活動名稱
+    if 'name' not in user_state:
+        logger.error("使用者 %s 的狀態無效", user_id)
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[RESTART_CREATION_MESSAGE]
+        )
+        reply_message(request)
+        return
 
-            if not activity:
-                return
+    activity_name = user_state.get('name')
 
-            # 獲取用戶名稱
-            try:
-                profile = messaging_api.get_profile(user_id)
-                user_name = profile.display_name
-            except Exception as e:
-                logger.error(f"Error getting user profile: {e}")
-                user_name = user_id
-
-            # 檢查是否已報名
-            participant = Participant.query.filter_by(
-                activity_id=activity_id,
-                user_id=user_id
-            ).first()
-
-            if participant:
-                # 取消報名
-                activity_name = participant.activity.name
-                db.session.delete(participant)
-                db.session.commit()
-                response_text = f"➜{activity_name}：{user_name} 已取消報名"
-            else:
-                # 尚未報名
-                response_text = f"➜{activity.name}：{user_name} 尚未報名"
+    # 檢查活動名稱是否存在
+    if not activity_name:
+        logger.error("活動名稱遺失")
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[INVALID_ACTIVITY_NAME_MESSAGE]
+        )
+        reply_message(request)
+        return
+
+    try:
+        # 將日期時間字串轉換為 datetime 物件
+        starts_at = datetime.strptime(datetime_selected, '%Y-%m-%dT%H:%M')
+
+        # 建立新的副本；名稱重複時不新增
+        new_activity_id = db.session.scalar(CREATE_ACTIVITY, {
+            'name': activity_name,
+            'starts_at': starts_at,
+            'creator_id': user_id
+        })
+        db.session.commit()
 
+        if new_activity_id is None:
+            logger.info("名為 %s 的副本已存在", activity_name)
+            response_text = f"已存在名為 {activity_name} 的副本"
             request = ReplyMessageRequest(
                 reply_token=event.reply_token,
                 messages=[TextMessage(text=response_text)]
             )
-            messaging_api.reply_message(request)
-
-        # 保留其他原有的 postback 處理邏輯
-        elif "action=delete_activity" in data:
-            # (原有的刪除副本邏輯)
-            activity_id = int(data.split('&id=')[1])
-            activity = Activity.query.get(activity_id)
-
-            if activity:
-                if activity.creator_id == user_id:
-                    activity_name = activity.name
-                    Participant.query.filter_by(activity_id=activity_id).delete()
-                    db.session.delete(activity)
-                    db.session.commit()
-                    response_text = f"➜{activity_name}：已刪除"
-                else:
-                    try:
-                        profile = messaging_api.get_profile(user_id)
-                        user_name = profile.display_name
-                    except:
-                        user_name = user_id
-                    response_text = f"➜{activity.name}：{user_name} 無刪除權限"
-
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=response_text)]
-                )
-                messaging_api.reply_message(request)
+            reply_message(request)
+            return
 
-        # 其他原有的 postback 處理（如查看參與者、刪除所有副本等）
-        elif "action=view_participants" in data:
-            # (原有的查看參與者邏輯)
-            activity_id = int(data.split('&id=')[1])
-            activity = Activity.query.get(activity_id)
+        bump_activities_version()
 
-            if activity:
-                participant_list = '\n'.join([
-                    f"✓ {p.user_name}" for p in activity.participants
-                ])
+        # 清除用戶狀態
+        clear_user_state(user_id)
 
-                response_text = (
-                    f"➜{activity.name} 報名名單\n"
-                    f"日期：{activity.date}\n"
-                    f"時間：{activity.time}\n"
-                    f"參加人數：{len(activity.participants)}人\n"
-                    f"-----------------\n"
-                    f"{participant_list}"
-                )
+        # 顯示副本列表
+        activities_list = create_activities_list_flex()
 
-                request = ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=response_text)]
-                )
-                messaging_api.reply_message(request)
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[activities_list]
+        )
+        reply_message(request)
 
-        # 刪除所有副本相關的 postback
-        elif "action=confirm_delete_all" in data:
-            Participant.query.delete()
-            Activity.query.delete()
-            db.session.commit()
-            response_text = "所有副本已刪除"
-            request = ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=response_text)]
-            )
-            messaging_api.reply_message(request)
+    except Exception as e:
+        logger.error("建立副本時發生資料庫錯誤：%s", e, exc_info=True)
+        db.session.rollback()
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[CREATE_ERROR_MESSAGE]
+        )
+        reply_message(request)
+        return
+
+
+def postback_join_activity(event, user_id, params):
+    """報名功能"""
+    activity_id = int(params['id'])
+    # 獲取用戶名稱；於查詢資料庫前取得，不在交易中等待 LINE API
+    user_name = get_user_name(user_id)
+    activity = get_activity(activity_id)
+
+    if activity:
+        # 尚未報名時才新增
+        new_participant_id = db.session.scalar(JOIN_ACTIVITY, {
+            'user_id': user_id,
+            'user_name': user_name,
+            'activity_id': activity_id
+        })
 
-        elif "action=cancel_delete_all" in data:
-            response_text = "已取消刪除所有副本"
-            request = ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=response_text)]
+        # 回覆內容於 commit 前組成，避免 commit 後屬性過期而重新查詢副本
+        if new_participant_id is None:
+            response_text = f"➜{activity.name}：{user_name} 已報名"
+        else:
+            response_text = (
+                f"➜{activity.name}：{user_name} 已成功報名\n"
+                f"日期：{activity.starts_at:%Y-%m-%d}\n"
+                f"時間：{activity.starts_at:%H:%M}\n"
+                f"目前參加人數：{count_participants(activity_id)}"
             )
-            messaging_api.reply_message(request)
+        db.session.commit()
+        if new_participant_id is not None:
+            bump_activities_version()
+
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=response_text)]
+        )
+        reply_message(request)
+
+
+def postback_cancel_join(event, user_id, params):
+    """取消報名功能"""
+    activity_id = int(params['id'])
+    # 獲取用戶名稱；於查詢資料庫前取得，不在交易中等待 LINE API
+    user_name = get_user_name(user_id)
+    activity = get_activity(activity_id)
+
+    if not activity:
+        return
+
+    # commit 後物件屬性會過期，先取出已載入的副本名稱
+    activity_name = activity.name
+
+    # 已報名時直接刪除，沒有刪除到資料即為尚未報名
+    deleted_id = db.session.scalar(
+        DELETE_PARTICIPANT_BY_USER, {'activity_id': activity_id, 'user_id': user_id}
+    )
+    db.session.commit()
+
+    if deleted_id is not None:
+        # 取消報名
+        bump_activities_version()
+        response_text = f"➜{activity_name}：{user_name} 已取消報名"
+    else:
+        # 尚未報名
+        response_text = f"➜{activity_name}：{user_name} 尚未報名"
+
+    request = ReplyMessageRequest(
+        reply_token=event.reply_token,
+        messages=[TextMessage(text=response_text)]
+    )
+    reply_message(request)
+
+
+def postback_delete_activity(event, user_id, params):
+    """刪除副本（限創建者）"""
+    activity_id = int(params['id'])
+    # 無刪除權限時的回覆需要用戶名稱；於刪除前取得，不在交易中等待 LINE API
+    user_name = get_user_name(user_id)
+    activity_name = db.session.scalar(
+        DELETE_ACTIVITY_BY_CREATOR, {'activity_id': activity_id, 'user_id': user_id}
+    )
+
+    if activity_name is not None:
+        db.session.commit()
+        clear_activity_cache(activity_id)
+        bump_activities_version()
+        response_text = f"➜{activity_name}：已刪除"
+    else:
+        # 沒有刪除到資料：副本不存在或非創建者，只有後者需要回覆
+        activity = get_activity(activity_id)
+        if activity is None:
+            return
+        activity_name = activity.name
+        response_text = f"➜{activity_name}：{user_name} 無刪除權限"
+
+    request = ReplyMessageRequest(
+        reply_token=event.reply_token,
+        messages=[TextMessage(text=response_text)]
+    )
+    reply_message(request)
+
+
+def postback_view_participants(event, user_id, params):
+    """查看報名名單"""
+    activity_id = int(params['id'])
+    rows = db.session.execute(PARTICIPANT_LIST, {'activity_id': activity_id}).all()
+
+    if rows:
+        activity_name, starts_at = rows[0][:2]
+        # 沒有參加者時 outer join 只會回傳一列 Participant 欄位為 NULL 的資料
+        user_names = [row.user_name for row in rows if row.id is not None]
+        participant_list = '\n'.join([
+            f"✓ {user_name}" for user_name in user_names
+        ])
+
+        response_text = (
+            f"➜{activity_name} 報名名單\n"
+            f"日期：{starts_at:%Y-%m-%d}\n"
+            f"時間：{starts_at:%H:%M}\n"
+            f"參加人數：{len(user_names)}人\n"
+            f"-----------------\n"
+            f"{participant_list}"
+        )
+
+        request = ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=response_text)]
+        )
+        reply_message(request)
+
+
+def postback_confirm_delete_all(event, user_id, params):
+    """確認刪除所有副本"""
+    # TRUNCATE 直接清空兩張表，不必逐列刪除；不重設序號以免舊訊息的按鈕對應到新副本
+    db.session.execute(db.text("TRUNCATE TABLE participant, activity"))
+    db.session.commit()
+    clear_activity_cache()
+    bump_activities_version()
+    request = ReplyMessageRequest(
+        reply_token=event.reply_token,
+        messages=[ALL_DELETED_MESSAGE]
+    )
+    reply_message(request)
+
+
+def postback_cancel_delete_all(event, user_id, params):
+    """取消刪除所有副本"""
+    request = ReplyMessageRequest(
+        reply_token=event.reply_token,
+        messages=[DELETE_ALL_CANCELLED_MESSAGE]
+    )
+    reply_message(request)
+
+
+# postback 的 action 對應處理函數；處理函數收到已解析的 query string
+# 副本列表按鈕使用精簡格式「代碼:副本id」，舊訊息中的 query string 格式仍可處理
+POSTBACK_SHORT_ACTIONS = {
+    'j': 'join_activity',
+    'c': 'cancel_join',
+    'v': 'view_participants',
+    'd': 'delete_activity',
+}
+POSTBACK_ACTIONS = {
+    'select_date': postback_select_date,
+    'join_activity': postback_join_activity,
+    'cancel_join': postback_cancel_join,
+    'delete_activity': postback_delete_activity,
+    'view_participants': postback_view_participants,
+    'confirm_delete_all': postback_confirm_delete_all,
+    'cancel_delete_all': postback_cancel_delete_all,
+}
+
+
+def handle_postback(event):
+    try:
+        user_id = event.source.user_id
+
+        # postback data 為精簡格式或 query string，只解析一次
+        data = event.postback.data
+        code, sep, activity_id = data.partition(':')
+        if sep and code in POSTBACK_SHORT_ACTIONS:
+            action = POSTBACK_SHORT_ACTIONS[code]
+            params = {'id': activity_id}
+        else:
+            params = dict(parse_qsl(data))
+            action = params.get('action')
+
+        postback_action = POSTBACK_ACTIONS.get(action)
+        if postback_action:
+            postback_action(event, user_id, params)
     except Exception as e:
-        logger.error(f"handle_postback 發生未預期錯誤：{str(e)}", exc_info=True)
+        logger.error("handle_postback 發生未預期錯誤：%s", e, exc_info=True)
         try:
             request = ReplyMessageRequest(
                 reply_token=event.reply_token,
-                messages=[TextMessage(text="處理請求時發生錯誤，請稍後再試。")]
+                messages=[POSTBACK_ERROR_MESSAGE]
             )
-            messaging_api.reply_message(request)
+            reply_message(request)
         except Exception as reply_error:
-            logger.error(f"發送錯誤訊息時發生錯誤：{str(reply_error)}")
+            logger.error("發送錯誤訊息時發生錯誤：%s", reply_error)
+
+
+# 事件註冊：實際處理交由執行緒池，讓同一 webhook 的多個事件並行
+@handler.add(MessageEvent, message=TextMessageContent)
+def on_text_message(event):
+    submit_event(handle_text_message, event)
+
+
+@handler.add(PostbackEvent)
+def on_postback(event):
+    submit_event(handle_postback, event)
+
 
 # 修改初始化數據庫的函數
 def init_db():
     with app.app_context():
         db.drop_all()  # 先刪除所有表格
         db.create_all()
+        # 重建表格後副本 id 會重新編號，使以 id 與版本為鍵的 Redis 快取失效
+        clear_activity_cache()
+        bump_activities_version()
         print("Database initialized")
 
 if __name__ == "__main__":